@@ -10,15 +10,21 @@ See README.md for more detailed usage instructions.
 __version__ = "0.2.3"
 
 import threading
+import contextvars
 import sys
 import logging
 import functools
+import importlib.util
 import pdb
 import inspect
+import io
 import tokenize
-import tempfile
+import linecache
+import itertools
+import copy
 import ast
-from typing import Any, Optional
+import os
+from typing import Iterable, Optional
 import types
 
 
@@ -61,17 +67,21 @@ else:
 HOT_RESTART_ALREADY_WRAPPED = "_hot_restart_already_wrapped"
 HOT_RESTART_NO_WRAP = "_hot_restart_no_wrap"
 
-# Thread locals used during reload
-HOT_RESTART_MODULE_RELOAD_CONTEXT = threading.local()
-HOT_RESTART_MODULE_RELOAD_CONTEXT.val = {}
+# Context variables used during reload
+# Unlike thread locals, these have a default value in every thread.
+# Mapping from module names to the namespace they are being restarted in.
+# Read-only, so it can only be replaced (not mutated) for the current context.
+HOT_RESTART_MODULE_RELOAD_CONTEXT = contextvars.ContextVar(
+    "HOT_RESTART_MODULE_RELOAD_CONTEXT", default=types.MappingProxyType({})
+)
 
 HOT_RESTART_SURROGATE_RESULT = "HOT_RESTART_SURROGATE_RESULT"
 
-HOT_RESTART_IN_SURROGATE_CONTEXT = threading.local()
-HOT_RESTART_IN_SURROGATE_CONTEXT.val = None
+HOT_RESTART_IN_SURROGATE_CONTEXT = contextvars.ContextVar(
+    "HOT_RESTART_IN_SURROGATE_CONTEXT", default=None
+)
 
-IS_RESTARTING_MODULE = threading.local()
-IS_RESTARTING_MODULE.val = False
+IS_RESTARTING_MODULE = contextvars.ContextVar("IS_RESTARTING_MODULE", default=False)
 
 # This needs to be settable from the debugger UI
 # Unfortunately we have no idea what thread the debugger will set this from
@@ -81,6 +91,31 @@ EXIT_THIS_FRAME = None
 class HotRestartPdb(pdb.Pdb):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        # Frame to start the next debugging session in, instead of the
+        # innermost frame.
+        self.restart_frame = None
+        # Pdb only runs its rc lines once, keep them to run again when this
+        # instance is re-used from PDB_POOL.
+        self.pdbrc_lines = list(self.rcLines)
+
+    def setup(self, f, tb):
+        res = super().setup(f, tb)
+        if self.restart_frame is not None:
+            # Equivalent to running "up" until reaching the restart frame, but
+            # without printing each intermediate frame.
+            for i in range(self.curindex, -1, -1):
+                if self.stack[i][0] is self.restart_frame:
+                    self.curindex = i
+                    self.curframe = self.stack[i][0]
+                    self.curframe_locals = self.curframe.f_locals
+                    if hasattr(self, "set_convenience_variable"):
+                        # Python 3.12+ tracks the selected frame as $_frame.
+                        self.set_convenience_variable(
+                            self.curframe, "_frame", self.curframe
+                        )
+                    break
+            self.restart_frame = None
+        return res
 
     def _cmdloop(self) -> None:
         self.cmdloop()
@@ -107,17 +142,55 @@ def reraise():
     EXIT_THIS_FRAME = True
 
 
-# Mapping from definition paths to temp files of reloaded code.
-# Temp files are allocated to hold surrogate source so that the debugger can
+# Mapping from definition paths to linecache names of reloaded code.
+# Surrogate sources are registered in linecache so that the debugger can
 # still show correct code listings even after the files are updated.
-# One source file is allocated per function.
+# One source is registered per function.
 TMP_SOURCE_FILES = {}
 
+# Used to give each registered surrogate source a unique name
+SURROGATE_SOURCE_COUNTER = itertools.count()
+
 # Mapping from surrogate source filenames to original filenames
 # Used to find the original source in cases of reloading an nested inner
 # function after the outer function has been reloaded
 TMP_SOURCE_ORIGINAL_MAP = {}
 
+# Mapping from (source filename, definition path) to the (base function,
+# module ast, reloaded function) of the last reload.
+# Continuing without editing the source file re-uses the reloaded function
+# instead of compiling it again.
+RELOAD_CACHE = {}
+
+# Mapping from (source filename, definition path, free variables, first line,
+# definition source text) to the (code, surrogate source name, global names)
+# compiled for it.
+# Editing another part of the file does not change the surrogate of a
+# definition, so its code can be re-used instead of compiled again.
+# Least recently used entries are evicted past CODE_CACHE_SIZE.
+CODE_CACHE = {}
+CODE_CACHE_SIZE = 128
+
+# Mapping from source filenames to the (module ast, module code) last compiled
+# by restart_module().
+# load_source() keeps the same ast while the file is unchanged, so restarting
+# an unedited module re-uses its code instead of compiling it again.
+MODULE_CODE_CACHE = {}
+
+# Module attributes used implicitly by code, which may not appear in co_names.
+# For example, __name__ is used to set __module__ of new functions, and
+# __package__ and __spec__ are used by relative imports.
+MODULE_DUNDERS = (
+    "__name__",
+    "__doc__",
+    "__package__",
+    "__loader__",
+    "__spec__",
+    "__path__",
+    "__file__",
+    "__builtins__",
+)
+
 
 class ReloadException(ValueError):
     """Exception when hot-restart fails to reload a function."""
@@ -125,42 +198,53 @@ class ReloadException(ValueError):
     pass
 
 
-class FindDefPath(ast.NodeVisitor):
+# Expression contexts have no fields, so one instance can be shared by every
+# node built by hot_restart (ast.parse does the same).
+AST_LOAD = ast.Load()
+AST_STORE = ast.Store()
+
+# Nodes which define a new name scope, and are part of definition paths.
+DEF_NODE_TYPES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+
+
+def find_def_path(
+    module_ast: ast.AST, target_name: str, target_lineno: int
+) -> Optional[tuple[str, ...]]:
     """Given a target name and line number of a definition, find a definition path.
 
     This gives a more durable identity to a function than its original line number.
     """
-
-    def __init__(self, target_name: str, target_lineno: int):
-        super().__init__()
-        self.target_name = target_name
-        self.target_lineno = target_lineno
-        self.found_def_paths = []
-        self.path_now = []
-
-    def generic_visit(self, node: ast.AST) -> Any:
-        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
-            self.path_now.append(node)
+    stack = [(module_ast, ())]
+    while stack:
+        node, path = stack.pop()
+        for child in ast.iter_child_nodes(node):
+            if not isinstance(child, DEF_NODE_TYPES):
+                # Expressions never contain definitions, and other nodes can
+                # only contain the target if they span its line.
+                if not isinstance(child, ast.expr) and (
+                    getattr(child, "lineno", target_lineno)
+                    <= target_lineno
+                    <= getattr(child, "end_lineno", target_lineno)
+                ):
+                    stack.append((child, path))
+                continue
             start_lineno = min(
-                [node.lineno] + [dec.lineno for dec in node.decorator_list]
+                [child.lineno] + [dec.lineno for dec in child.decorator_list]
             )
-            end_lineno = getattr(node, "end_lineno", 0)
-            if node.name == self.target_name:
-                if (
-                    start_lineno <= self.target_lineno
-                    and self.target_lineno <= end_lineno
-                ):
-                    self.found_def_paths.append([node.name for node in self.path_now])
-                else:
-                    _LOGGER.debug("Found matching name to def at wrong lineno:")
-                    _LOGGER.debug(f"    target_lineno = {self.target_lineno}")
-                    _LOGGER.debug(f"    start_lineno = {start_lineno}")
-                    _LOGGER.debug(f"    end_lineno = {end_lineno}")
-            res = super().generic_visit(node)
-            self.path_now.pop()
-            return res
-        else:
-            return super().generic_visit(node)
+            end_lineno = getattr(child, "end_lineno", 0)
+            if start_lineno <= target_lineno <= end_lineno:
+                child_path = path + (child.name,)
+                if child.name == target_name:
+                    return child_path
+                stack.append((child, child_path))
+            elif child.name == target_name:
+                # Nested definitions are inside this one's lines, so none of
+                # them can be the target.
+                _LOGGER.debug("Found matching name to def at wrong lineno:")
+                _LOGGER.debug(f"    target_lineno = {target_lineno}")
+                _LOGGER.debug(f"    start_lineno = {start_lineno}")
+                _LOGGER.debug(f"    end_lineno = {end_lineno}")
+    return None
 
 
 class SuperRewriteTransformer(ast.NodeTransformer):
@@ -172,10 +256,14 @@ class SuperRewriteTransformer(ast.NodeTransformer):
     mismatch, but allows adding new calls to super() in non-nested classes).
     """
 
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        class_name_stack: Optional[list[str]] = None,
+        first_arg_stack: Optional[list[str]] = None,
+    ) -> None:
         super().__init__()
-        self.class_name_stack = []
-        self.first_arg_stack = []
+        self.class_name_stack = list(class_name_stack or [])
+        self.first_arg_stack = list(first_arg_stack or [])
 
     def visit_ClassDef(self, node: ast.ClassDef):
         self.class_name_stack.append(node.name)
@@ -202,8 +290,12 @@ class SuperRewriteTransformer(ast.NodeTransformer):
         if getattr(node.func, "id", None) == "super" and len(node.args) == 0:
             try:
                 node.args = [
-                    ast.Name(self.class_name_stack[-1]),
-                    ast.Name(self.first_arg_stack[-1]),
+                    ast.copy_location(
+                        ast.Name(self.class_name_stack[-1], ctx=AST_LOAD), node
+                    ),
+                    ast.copy_location(
+                        ast.Name(self.first_arg_stack[-1], ctx=AST_LOAD), node
+                    ),
                 ]
             except IndexError:
                 _LOGGER.error(f"Could not rewrite super() call at line {node.lineno}")
@@ -211,6 +303,23 @@ class SuperRewriteTransformer(ast.NodeTransformer):
         return node
 
 
+def locate(new_node: ast.AST, old_node: ast.AST) -> ast.AST:
+    """Gives a generated node (and its children) the location of old_node."""
+    return ast.fix_missing_locations(ast.copy_location(new_node, old_node))
+
+
+# Statements which can contain definitions in their body or orelse.
+COMPOUND_STATEMENTS = (
+    ast.If,
+    ast.For,
+    ast.AsyncFor,
+    ast.While,
+    ast.With,
+    ast.AsyncWith,
+    ast.Try,
+) + ((ast.TryStar,) if hasattr(ast, "TryStar") else ())
+
+
 class SurrogateTransformer:
     """Transforms module source ast into a module only containing a target
     function and any surrounding scopes necessary for the compile to build the
@@ -222,22 +331,46 @@ class SurrogateTransformer:
     over __class__.
     """
 
-    def __init__(self, target_path: list[str], free_vars: list[str]):
+    def __init__(
+        self,
+        target_path: tuple[str, ...],
+        free_vars: tuple[str, ...],
+        rewrite_super: bool = True,
+    ):
         self.target_path = target_path
+        self.rewrite_super = rewrite_super
         self.depth = 0
         self.target_nodes = []
-        self.original_lineno = 0
         self.free_vars = free_vars
+        # Names of enclosing classes and first arguments of enclosing
+        # functions, used to rewrite super() in the target.
+        self.class_names = []
+        self.first_args = []
 
     def flatten_module(self, node: ast.Module) -> ast.Module:
         return ast.Module(
             body=self.visit_body(node.body), type_ignores=node.type_ignores
         )
 
-    def visit_body(self, nodes: list[ast.AST]) -> list[ast.AST]:
+    def visit_body(self, nodes: Iterable[ast.AST]) -> list[ast.AST]:
         new_nodes = []
-        for n in nodes:
-            new_nodes.extend(self.flatten_visit(n))
+        # Bodies of other compound statements (if, for, with, etc.) are
+        # flattened into this body in order, using a stack of iterators
+        # instead of recursing for each level of nesting.
+        stack = [iter(nodes)]
+        # AsyncFunctionDef is not supported as part of a definition path.
+        def_types = (ast.ClassDef, ast.FunctionDef)
+        target_nodes = self.target_nodes
+        # Stop once the target is found, since any later definitions with the
+        # same path would not be used.
+        while stack and not target_nodes:
+            n = next(stack[-1], None)
+            if n is None:
+                stack.pop()
+            elif isinstance(n, def_types):
+                new_nodes.extend(self.flatten_visit(n))
+            elif isinstance(n, COMPOUND_STATEMENTS):
+                stack.append(itertools.chain(n.body, getattr(n, "orelse", ())))
         return new_nodes
 
     def flatten_visit(self, node: ast.AST) -> list[ast.AST]:
@@ -246,51 +379,92 @@ class SurrogateTransformer:
                 return []
             try:
                 self.depth += 1
+                self.class_names.append(node.name)
                 return [
-                    ast.ClassDef(
-                        name=node.name,
-                        bases=[],
-                        keywords=node.keywords,
-                        body=self.visit_body(node.body),
-                        decorator_list=[],
+                    ast.copy_location(
+                        ast.ClassDef(
+                            name=node.name,
+                            bases=[],
+                            keywords=node.keywords,
+                            body=self.visit_body(node.body),
+                            decorator_list=[],
+                        ),
+                        node,
                     )
                 ]
             finally:
                 self.depth -= 1
+                self.class_names.pop()
         elif isinstance(node, ast.FunctionDef):
             if node.name != self.target_path[self.depth]:
                 return []
             try:
                 self.depth += 1
                 if self.depth == len(self.target_path):
-                    self.original_lineno = node.lineno
                     # Found the function def
-                    self.target_nodes.append(
+                    # Keep the original location, so that line numbers in the
+                    # compiled code match the original source.
+                    target = ast.copy_location(
                         ast.FunctionDef(
                             name=node.name,
                             args=node.args,
                             body=node.body,
                             decorator_list=node.decorator_list,
                             returns=node.returns,
-                        )
+                        ),
+                        node,
                     )
-                    freevar_bindings = ast.parse(
-                        "\n".join(
-                            f"{var} = 'HOT_RESTART_LOST_CLOSURE'"
-                            for var in self.free_vars
+                    # Only the target can contain super() calls.
+                    if self.rewrite_super and any(
+                        isinstance(n, ast.Call)
+                        and getattr(n.func, "id", None) == "super"
+                        and not n.args
+                        for n in ast.walk(target)
+                    ):
+                        # Rewrite a copy, so the cached module ast is unchanged.
+                        target = copy.deepcopy(target)
+                        SuperRewriteTransformer(
+                            self.class_names, self.first_args
+                        ).visit(target)
+                    self.target_nodes.append(target)
+                    # <var> = 'HOT_RESTART_LOST_CLOSURE'
+                    res = [
+                        locate(
+                            ast.Assign(
+                                targets=[ast.Name(var, ctx=AST_STORE)],
+                                value=ast.Constant("HOT_RESTART_LOST_CLOSURE"),
+                            ),
+                            node,
+                        )
+                        for var in self.free_vars
+                    ]
+                    res.append(self.target_nodes[-1])
+                    # If the original function was explicitly wrapped, the
+                    # wrapper will set HOT_RESTART_SURROGATE_RESULT,
+                    # otherwise generate some code here to set it.
+                    # globals().setdefault('HOT_RESTART_SURROGATE_RESULT', <name>)
+                    res.append(
+                        locate(
+                            ast.Expr(
+                                ast.Call(
+                                    func=ast.Attribute(
+                                        value=ast.Call(
+                                            func=ast.Name("globals", ctx=AST_LOAD),
+                                            args=[],
+                                            keywords=[],
+                                        ),
+                                        attr="setdefault",
+                                        ctx=AST_LOAD,
+                                    ),
+                                    args=[
+                                        ast.Constant(HOT_RESTART_SURROGATE_RESULT),
+                                        ast.Name(node.name, ctx=AST_LOAD),
+                                    ],
+                                    keywords=[],
+                                )
+                            ),
+                            node,
                         )
-                    ).body
-                    res = (
-                        freevar_bindings
-                        + [
-                            self.target_nodes[-1]
-                            # If the original function was explicitly wrapped, the
-                            # wrapper will set HOT_RESTART_SURROGATE_RESULT,
-                            # otherwise generate some code here to set it.
-                        ]
-                        + ast.parse(
-                            f"globals().setdefault('HOT_RESTART_SURROGATE_RESULT', {node.name})"
-                        ).body
                     )
                     return res
                 else:
@@ -302,42 +476,76 @@ class SurrogateTransformer:
                     # function so that closure bindings are created
                     # correctly
 
-                    new_body = self.visit_body(node.body)
+                    if node.args.args:
+                        self.first_args.append(node.args.args[0].arg)
+                    try:
+                        new_body = self.visit_body(node.body)
+                    finally:
+                        if node.args.args:
+                            self.first_args.pop()
                     new_body.append(
-                        ast.Return(
-                            value=ast.Name(self.target_path[self.depth], ctx=ast.Load())
+                        locate(
+                            ast.Return(
+                                value=ast.Name(
+                                    self.target_path[self.depth], ctx=AST_LOAD
+                                )
+                            ),
+                            node,
                         )
                     )
                     res = [
-                        ast.FunctionDef(
-                            name=node.name,
-                            args=[],
-                            body=new_body,
-                            decorator_list=[],
-                            returns=node.returns,
+                        ast.copy_location(
+                            ast.FunctionDef(
+                                name=node.name,
+                                args=ast.arguments(
+                                    posonlyargs=[],
+                                    args=[],
+                                    kwonlyargs=[],
+                                    kw_defaults=[],
+                                    defaults=[],
+                                ),
+                                body=new_body,
+                                decorator_list=[],
+                                returns=node.returns,
+                            ),
+                            node,
                         ),
-                        # Immediately call the function, so the inner closure gets created
-                    ] + ast.parse(f"{node.name}()").body
+                    ]
+                    # Immediately call the function, so the inner closure gets created
+                    res.append(
+                        locate(
+                            ast.Expr(
+                                ast.Call(
+                                    func=ast.Name(node.name, ctx=AST_LOAD),
+                                    args=[],
+                                    keywords=[],
+                                )
+                            ),
+                            node,
+                        )
+                    )
                     return res
             finally:
                 self.depth -= 1
-        elif hasattr(node, "body") or hasattr(node, "orelse"):
-            return self.visit_body(
-                getattr(node, "body", []) + getattr(node, "orelse", [])
-            )
-        else:
-            return []
 
 
 def build_surrogate_source(source_text, module_ast, def_path, free_vars):
-    """Builds a source file containing the definition of def_path at the same
-    lineno as in the ast, with the same parent class(es), but with all other
-    lines empty.
+    """Builds a module ast containing the definition of def_path at the same
+    lineno as in the original ast, with the same parent class(es), but with all
+    other definitions removed.
+
+    Returns the module ast and the definition node within it.
+
+    The result is compiled directly, so line numbers in the reloaded code match
+    source_text.
     """
-    SuperRewriteTransformer().visit(module_ast)
-    trans = SurrogateTransformer(target_path=def_path, free_vars=free_vars)
-    new_ast = ast.fix_missing_locations(trans.flatten_module(module_ast))
-    source = ast.unparse(new_ast)
+    trans = SurrogateTransformer(
+        target_path=def_path,
+        free_vars=free_vars,
+        # Avoid searching the target for super() calls if there are none.
+        rewrite_super="super" in source_text,
+    )
+    new_ast = trans.flatten_module(module_ast)
     target_nodes = trans.target_nodes
     def_path_str = ".".join(def_path)
     if len(target_nodes) == 0:
@@ -346,20 +554,123 @@ def build_surrogate_source(source_text, module_ast, def_path, free_vars):
         _LOGGER.error("=== END SOURCE TEXT ===")
         _LOGGER.error(ast.dump(new_ast, indent=2))
         raise ReloadException(f"Could not find {def_path_str} in new source")
-    if len(target_nodes) > 1:
-        _LOGGER.error(f"Overlapping definitions of {def_path_str} in source")
-    target_node = target_nodes[0]
-    missing_lines = trans.original_lineno - target_node.lineno
-    surrogate_src = "\n" * missing_lines + source
-    return surrogate_src
+    return new_ast, target_nodes[0]
+
+
+def build_def_index(
+    module_ast: ast.AST,
+) -> dict[tuple[str, int], tuple[str, ...]]:
+    """Maps the (name, first line number) of every definition in a module to
+    its definition path.
+
+    The first line number includes decorators, matching co_firstlineno.
+    """
+    index = {}
+    stack = [(module_ast, ())]
+    while stack:
+        node, path = stack.pop()
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, DEF_NODE_TYPES):
+                child_path = path + (child.name,)
+                start_lineno = min(
+                    [child.lineno] + [dec.lineno for dec in child.decorator_list]
+                )
+                index.setdefault((child.name, start_lineno), child_path)
+                stack.append((child, child_path))
+            else:
+                stack.append((child, path))
+    return index
 
 
-@functools.cache
-def parse_src(source: str) -> ast.AST:
-    return ast.parse(source)
+# Mapping from code object filenames to their source filename.
+# inspect.getsourcefile() checks the filesystem, so only do it once per file.
+# This is keyed by co_filename rather than by code object, since code objects
+# compare equal across files when their contents match.
+SOURCE_FILENAMES = {}
 
 
-def get_def_path(func) -> Optional[list[str]]:
+def get_source_filename(func) -> Optional[str]:
+    code = getattr(func, "__code__", None)
+    if code is None:
+        return inspect.getsourcefile(func)
+    co_filename = code.co_filename
+    try:
+        return SOURCE_FILENAMES[co_filename]
+    except KeyError:
+        pass
+    source_filename = co_filename
+    # Handle the common cases directly, inspect.getsourcefile() also considers
+    # bytecode files and import loaders.
+    if source_filename not in TMP_SOURCE_ORIGINAL_MAP and not (
+        source_filename.endswith(".py") and os.path.exists(source_filename)
+    ):
+        source_filename = inspect.getsourcefile(func)
+    SOURCE_FILENAMES[co_filename] = source_filename
+    return source_filename
+
+
+# Mapping from source filenames to (stat key, source text, module ast, def index).
+# The stat key is (st_mtime_ns, st_size), so edited files are re-read and
+# re-parsed, while unchanged files only cost an os.stat().
+SOURCE_CACHE = {}
+
+
+def load_source(
+    source_filename: str,
+) -> tuple[str, ast.AST, dict[tuple[str, int], tuple[str, ...]]]:
+    """Returns the source text, parsed ast, and definition index of a file,
+    re-using the cached version if the file has not changed on disk."""
+    cached = SOURCE_CACHE.get(source_filename)
+    if source_filename in TMP_SOURCE_ORIGINAL_MAP:
+        # Surrogate sources only exist in linecache, and never change.
+        key = None
+        if cached is not None:
+            return cached[1:]
+        source = "".join(linecache.getlines(source_filename))
+    else:
+        st = os.stat(source_filename)
+        key = (st.st_mtime_ns, st.st_size)
+        if cached is not None and cached[0] == key:
+            return cached[1:]
+        entry = linecache.cache.get(source_filename)
+        if (
+            # linecache.lazycache() entries are 1-tuples, without source.
+            entry is not None
+            and len(entry) == 4
+            and entry[1] == st.st_mtime
+            and entry[0] == st.st_size
+        ):
+            # Printing a traceback usually already read the file.
+            source = "".join(entry[2])
+        else:
+            # Read the bytes in one go and decode them the way the import
+            # system does, honoring any coding declaration.
+            with open(source_filename, "rb") as f:
+                source = importlib.util.decode_source(f.read())
+            # Prime linecache, so pdb and tracebacks show the source that was
+            # just loaded instead of a stale version (or reading it again).
+            lines = io.StringIO(source).readlines()
+            if lines and not lines[-1].endswith("\n"):
+                lines[-1] += "\n"
+            linecache.cache[source_filename] = (
+                st.st_size,
+                st.st_mtime,
+                lines,
+                source_filename,
+            )
+        if cached is not None and cached[1] == source:
+            # Saved without changes, keep the same ast (so RELOAD_CACHE hits).
+            SOURCE_CACHE[source_filename] = (key,) + cached[1:]
+            return cached[1:]
+    module_ast = ast.parse(source, filename=source_filename)
+    def_index = build_def_index(module_ast)
+    SOURCE_CACHE[source_filename] = (key, source, module_ast, def_index)
+    return source, module_ast, def_index
+
+
+def get_def_path(
+    func, source_filename: Optional[str] = None
+) -> Optional[tuple[str, ...]]:
     unwrapped_func = inspect.unwrap(func)
     if unwrapped_func is not func:
         _LOGGER.debug("Finding def path of wrapped function.")
@@ -374,116 +685,261 @@ def get_def_path(func) -> Optional[list[str]]:
             f"unwrapped function {unwrapped_func!r} has source file {inspect.getsourcefile(unwrapped_func)}"
         )
 
-    source_filename = inspect.getsourcefile(unwrapped_func)
+    if source_filename is None:
+        source_filename = get_source_filename(unwrapped_func)
     if source_filename == "<string>" or source_filename is None:
         raise ReloadException(f"{func!r} was generated and has no source")
-    with open(source_filename, "r") as f:
-        source_content = f.read()
-    module_ast = parse_src(source_content)
+    if inspect.iscoroutinefunction(unwrapped_func) or inspect.isasyncgenfunction(
+        unwrapped_func
+    ):
+        raise ReloadException(f"{func!r} is async, which is not supported")
+    source_content, module_ast, def_index = load_source(source_filename)
     func_name = unwrapped_func.__name__
     func_lineno = unwrapped_func.__code__.co_firstlineno
-    visitor = FindDefPath(target_name=func_name, target_lineno=func_lineno)
-    visitor.visit(module_ast)
-    if len(visitor.found_def_paths) == 0:
-        _LOGGER.error(f"Could not find definition of {unwrapped_func!r}")
-        _LOGGER.debug(ast.dump(module_ast, indent=2))
-        return None
-    def_path = visitor.found_def_paths[0]
-    # Check that we can build a surrogate source for this func
-    build_surrogate_source(
-        source_content, module_ast, def_path, unwrapped_func.__code__.co_freevars
-    )
-    return visitor.found_def_paths[0]
+    def_path = def_index.get((func_name, func_lineno))
+    if def_path is None:
+        # co_firstlineno does not always match the start of the definition
+        # exactly, fall back to searching the ast.
+        def_path = find_def_path(module_ast, func_name, func_lineno)
+        if def_path is None:
+            _LOGGER.error(f"Could not find definition of {unwrapped_func!r}")
+            _LOGGER.debug(ast.dump(module_ast, indent=2))
+            return None
+        # Remember the result for other functions created by this definition.
+        def_index[(func_name, func_lineno)] = def_path
+    return def_path
+
+
+# Mapping from (source filename, definition path) to the (stat key, result) of
+# checking that a surrogate source can be built for that definition.
+# Nested definitions are wrapped again on every call of the enclosing function,
+# so each definition is only checked (and reported) once per version of its
+# file.
+CHECKED_DEF_PATHS = {}
+
+
+def check_reloadable(func, source_filename: str, def_path: tuple[str, ...]) -> bool:
+    """Checks that a surrogate source can be built for the definition of func,
+    so that it can be reloaded later."""
+    source_content, module_ast, _ = load_source(source_filename)
+    stat_key = SOURCE_CACHE[source_filename][0]
+    check_key = (source_filename, def_path)
+    checked = CHECKED_DEF_PATHS.get(check_key)
+    if checked is not None and checked[0] == stat_key:
+        return checked[1]
+    try:
+        build_surrogate_source(
+            source_content,
+            module_ast,
+            def_path,
+            inspect.unwrap(func).__code__.co_freevars,
+        )
+        reloadable = True
+    except ReloadException as e:
+        _LOGGER.error(f"Could not wrap {func!r}: {e}")
+        reloadable = False
+    CHECKED_DEF_PATHS[check_key] = (stat_key, reloadable)
+    return reloadable
+
+
+def code_global_names(code: types.CodeType) -> set[str]:
+    """Returns every name that code, or code nested in it, may look up as a
+    global."""
+    names = set()
+    stack = [code]
+    while stack:
+        code = stack.pop()
+        names.update(code.co_names)
+        stack.extend(
+            const for const in code.co_consts if isinstance(const, types.CodeType)
+        )
+    return names
+
+
+def match_closure(new_code, old_func, def_str: str) -> tuple:
+    """Returns closure cells for new_code, taken from old_func by free
+    variable name."""
+    old_closure = old_func.__closure__
+    if old_closure is None:
+        old_closure = ()
+    if new_code.co_freevars == old_func.__code__.co_freevars:
+        # Usual case, the same variables are closed over in the same order.
+        return old_closure
+    old_cells = dict(zip(old_func.__code__.co_freevars, old_closure))
+    closure = []
+    for var in new_code.co_freevars:
+        cell = old_cells.get(var)
+        if cell is None:
+            _LOGGER.error(
+                f"New {def_str} closes over {var!r}, which was not closed over before"
+            )
+            _LOGGER.error(f"Closure variable {var!r} in {def_str} lost")
+            cell = types.CellType("HOT_RESTART_LOST_CLOSURE")
+        closure.append(cell)
+    return tuple(closure)
+
 
+def same_function(new_func, old_func) -> bool:
+    """Checks if a newly loaded function is equivalent to an old one.
 
-def reload_function(def_path: list[str], func):
+    Code objects compare equal when their bytecode, constants, names, and line
+    numbers match, so this only ignores the function's filename.
+    """
+    try:
+        return bool(
+            new_func.__code__ == old_func.__code__
+            and new_func.__defaults__ == old_func.__defaults__
+            and new_func.__kwdefaults__ == old_func.__kwdefaults__
+        )
+    except Exception:
+        # Comparing default values can fail for some types
+        return False
+
+
+def reload_function(
+    def_path: tuple[str, ...],
+    func,
+    source_filename: Optional[str] = None,
+    module: Optional[types.ModuleType] = None,
+):
     """Takes in a definition path and function, and returns a new version of
     that function reloaded from source.
 
+    The source filename and module of func can be passed in if they are
+    already known (wrap() looks them up once), otherwise they are inspected.
+
     This _does not_ cause the function to be reloaded in place (that's
     significantly more difficult to do, especially in a thread safe way).
     """
 
     def_str = ".".join(def_path)
     unwrapped_func = inspect.unwrap(func)
-    source_filename = inspect.getsourcefile(unwrapped_func)
+    if source_filename is None:
+        source_filename = get_source_filename(unwrapped_func)
     source_filename = TMP_SOURCE_ORIGINAL_MAP.get(source_filename, source_filename)
     _LOGGER.debug(f"Reloading {def_str} from {source_filename}")
+    if source_filename is None:
+        # Probably used in an interactive session or something, which
+        # we don't know how to get source code from.
+        _LOGGER.error(f"Could not reload {func!r}: No known source file")
+        return None
     try:
-        with open(source_filename, "r") as f:
-            all_source = f.read()
+        all_source, src_ast, _ = load_source(source_filename)
     except (OSError, FileNotFoundError, tokenize.TokenError) as e:
         _LOGGER.error(
             f"Could not read source for {func!r} from {source_filename}: {e!r}"
         )
         return None
-    try:
-        src_ast = ast.parse(all_source, filename=source_filename)
     except SyntaxError as e:
         _LOGGER.error(f"Could not parse source for {func!r}: {e!r}")
         return None
 
-    module = inspect.getmodule(func)
-    if source_filename is None:
-        # Probably used in an interactive session or something, which
-        # we don't know how to get source code from.
-        _LOGGER.error(f"Could not reload {func!r}: No known source file")
-        return None
+    if module is None:
+        module = inspect.getmodule(func)
+
+    cache_key = (source_filename, def_str)
+    cached = RELOAD_CACHE.get(cache_key)
+    if cached is not None and cached[0] is func and cached[1] is src_ast:
+        _LOGGER.debug(f"Source of {def_str} is unchanged, re-using last reload")
+        return cached[2]
     try:
-        surrogate_src = build_surrogate_source(
+        surrogate_ast, target_node = build_surrogate_source(
             all_source, src_ast, def_path, unwrapped_func.__code__.co_freevars
         )
     except ReloadException:
         return None
 
-    # Create a "flattened filename" to use as a temp file suffix.
-    # This way we avoid needing to clean up any temporary directories.
-    flat_filename = (
-        source_filename.replace("/", "_").replace("\\", "_").replace(":", "_")
+    # Split lines like linecache does, since str.splitlines() also splits on
+    # characters such as form feeds, which do not end a line for Python.
+    source_lines = io.StringIO(all_source).readlines()
+    start_lineno = min(
+        [target_node.lineno] + [dec.lineno for dec in target_node.decorator_list]
     )
-    temp_source = tempfile.NamedTemporaryFile(suffix=flat_filename, mode="w")
-    temp_source.write(surrogate_src)
-    temp_source.flush()
-    _LOGGER.debug("=== SURROGATE SOURCE BEGIN ===")
-    _LOGGER.debug(surrogate_src)
-    _LOGGER.debug("=== SURROGATE SOURCE END ===")
-
-    surrogate_filename = temp_source.name
-    if DEBUG_ORIGINAL_PATH_FOR_RELOADED_CODE:
-        _LOGGER.warn(f"Faking path of generated source for {func!r}")
-        _LOGGER.warn(f"Real generated code source is in {temp_source.name}")
-        surrogate_filename = source_filename
-    code = compile(surrogate_src, surrogate_filename, "exec")
-    ctxt = dict(vars(module))
+    code_key = (
+        source_filename,
+        def_str,
+        unwrapped_func.__code__.co_freevars,
+        start_lineno,
+        "".join(source_lines[start_lineno - 1 : target_node.end_lineno]),
+    )
+    cached_code = CODE_CACHE.pop(code_key, None)
+    if cached_code is not None and not DEBUG_ORIGINAL_PATH_FOR_RELOADED_CODE:
+        _LOGGER.debug(f"Source of {def_str} is unchanged, re-using compiled code")
+        code, surrogate_name, global_names = cached_code
+        SOURCE_CACHE.pop(surrogate_name, None)
+    else:
+        surrogate_name = f"<hot-restart:{def_str}:{next(SURROGATE_SOURCE_COUNTER)}>"
+        code = None
+    # The surrogate ast keeps the line numbers of the original source, so
+    # register a snapshot of that source with linecache under a unique name.
+    # This lets the debugger show correct code listings even after the file
+    # is updated, without writing a temp file.
+    # When re-using code, the definition is on the same lines of the current
+    # source, so the snapshot is refreshed in case it was already evicted.
+    linecache.cache[surrogate_name] = (
+        len(all_source),
+        None,
+        source_lines,
+        surrogate_name,
+    )
+    if _LOGGER.isEnabledFor(logging.DEBUG):
+        _LOGGER.debug("=== SURROGATE SOURCE BEGIN ===")
+        _LOGGER.debug(ast.unparse(surrogate_ast))
+        _LOGGER.debug("=== SURROGATE SOURCE END ===")
+
+    if code is None:
+        surrogate_filename = surrogate_name
+        if DEBUG_ORIGINAL_PATH_FOR_RELOADED_CODE:
+            _LOGGER.warn(f"Faking path of generated source for {func!r}")
+            _LOGGER.warn(
+                f"Real generated code source is in linecache as {surrogate_name}"
+            )
+            surrogate_filename = source_filename
+        code = compile(surrogate_ast, surrogate_filename, "exec")
+        global_names = code_global_names(code)
+    CODE_CACHE[code_key] = (code, surrogate_name, global_names)
+    if len(CODE_CACHE) > CODE_CACHE_SIZE:
+        del CODE_CACHE[next(iter(CODE_CACHE))]
+    # Only copy the globals the surrogate can use, instead of the whole module.
+    # Reloaded functions are usually rebuilt over func.__globals__, so do not
+    # keep this namespace.
+    module_vars = vars(module)
+    ctxt = {
+        name: module_vars[name]
+        for name in itertools.chain(MODULE_DUNDERS, global_names)
+        if name in module_vars
+    }
 
     if HOT_RESTART_SURROGATE_RESULT in ctxt:
         del ctxt[HOT_RESTART_SURROGATE_RESULT]
         _LOGGER.error("Leftover result from surrogate load")
 
+    token = HOT_RESTART_IN_SURROGATE_CONTEXT.set(ctxt)
     try:
-        HOT_RESTART_IN_SURROGATE_CONTEXT.val = ctxt
         exec(code, ctxt, ctxt)
     finally:
-        HOT_RESTART_IN_SURROGATE_CONTEXT.val = None
+        HOT_RESTART_IN_SURROGATE_CONTEXT.reset(token)
     raw_func = ctxt.get(HOT_RESTART_SURROGATE_RESULT, None)
     if raw_func is None:
         _LOGGER.error(f"Could not reload {func!r}: Could not find {def_str}")
         return None
+    if isinstance(raw_func, (staticmethod, classmethod)):
+        # wrap_class() wraps the function underneath these.
+        raw_func = raw_func.__func__
     if raw_func is inspect.unwrap(raw_func):
+        if (
+            cached is not None
+            and cached[0] is func
+            and same_function(raw_func, cached[2])
+        ):
+            # Only other parts of the source changed, keep the last version
+            # (and its surrogate source).
+            _LOGGER.debug(f"Code of {def_str} is unchanged, re-using last reload")
+            if surrogate_name != TMP_SOURCE_FILES.get(def_str):
+                linecache.cache.pop(surrogate_name, None)
+            RELOAD_CACHE[cache_key] = (func, src_ast, cached[2])
+            return cached[2]
         # We are wrapping directly, patch up closure.
-        closure = unwrapped_func.__closure__
-        if closure is None:
-            closure = ()
-        n_freevars = len(raw_func.__code__.co_freevars)
-        if not isinstance(closure, tuple) or n_freevars != len(closure):
-            _LOGGER.error(
-                f"New {def_str} has closure cells {closure!r}"
-                f" but {n_freevars} cells were expected"
-            )
-            _LOGGER.error(f"Closures in {def_str} lost")
-            closure = tuple(
-                [types.CellType("HOT_RESTART_LOST_CLOSURE") for _ in range(n_freevars)]
-            )
         new_func = types.FunctionType(
             raw_func.__code__,
             func.__globals__,
@@ -492,17 +948,28 @@ def reload_function(def_path: list[str], func):
             # If the new source "closes over" new variables, then those will
             # turn into confusing "global not defined" messages.
             # TODO(krzentner): Find a way to print a good error message in this case.
-            closure,
+            match_closure(raw_func.__code__, unwrapped_func, def_str),
         )
+        new_func.__kwdefaults__ = raw_func.__kwdefaults__
     else:
         # We already warn about this on wrap, no need to repeat on reload
         _LOGGER.debug(
             f"wrap was not innermost decorator of {def_str}, closures will not work"
         )
+        # The new function keeps the surrogate namespace as its globals, so it
+        # also needs the globals it may look up indirectly (e.g. with eval()).
+        for name, value in module_vars.items():
+            ctxt.setdefault(name, value)
         new_func = raw_func
-    # Keep new temp file alive until function is reloaded again
-    TMP_SOURCE_FILES[def_str] = temp_source
-    TMP_SOURCE_ORIGINAL_MAP[temp_source.name] = source_filename
+    # Keep new surrogate source alive until function is reloaded again
+    old_surrogate_name = TMP_SOURCE_FILES.get(def_str)
+    if old_surrogate_name is not None and old_surrogate_name != surrogate_name:
+        linecache.cache.pop(old_surrogate_name, None)
+        SOURCE_CACHE.pop(old_surrogate_name, None)
+        SOURCE_FILENAMES.pop(old_surrogate_name, None)
+    TMP_SOURCE_FILES[def_str] = surrogate_name
+    TMP_SOURCE_ORIGINAL_MAP[surrogate_name] = source_filename
+    RELOAD_CACHE[cache_key] = (func, src_ast, new_func)
     return new_func
 
 
@@ -518,6 +985,7 @@ def wrap(
     func=None,
     *,
     propagated_exceptions: tuple[type[Exception], ...] = (StopIteration,),
+    # KeyboardInterrupt is not an Exception, so it is never caught by wrap().
     propagate_keyboard_interrupt: bool = True,
 ):
     if inspect.isclass(func):
@@ -534,9 +1002,10 @@ def wrap(
             propagate_keyboard_interrupt=propagate_keyboard_interrupt,
         )
 
-    if HOT_RESTART_IN_SURROGATE_CONTEXT.val:
+    surrogate_ctxt = HOT_RESTART_IN_SURROGATE_CONTEXT.get()
+    if surrogate_ctxt is not None:
         # We're in surrogate source, don't wrap again (or override the FUNC_BASE
-        HOT_RESTART_IN_SURROGATE_CONTEXT.val[HOT_RESTART_SURROGATE_RESULT] = func
+        surrogate_ctxt[HOT_RESTART_SURROGATE_RESULT] = func
         return func
 
     if getattr(func, HOT_RESTART_ALREADY_WRAPPED, False):
@@ -545,8 +1014,14 @@ def wrap(
 
     _LOGGER.debug(f"Wrapping {func!r}")
 
+    unwrapped_func = inspect.unwrap(func)
     try:
-        _def_path = get_def_path(func)
+        source_filename = get_source_filename(unwrapped_func)
+        _def_path = get_def_path(func, source_filename)
+        if _def_path is not None and not check_reloadable(
+            func, source_filename, _def_path
+        ):
+            return func
     except ReloadException as e:
         _LOGGER.error(f"Could not wrap {func!r}: {e}")
         return func
@@ -557,12 +1032,16 @@ def wrap(
     if _def_path is None:
         _LOGGER.error(f"Could not get definition path for {func!r}")
         # Assume it's the trivial path
-        def_path = [func.__name__]
+        def_path = (func.__name__,)
     else:
         def_path = _def_path
-    def_path_str = ".".join([func.__module__] + def_path)
+    # Nested definitions are wrapped again on every call of the outer function.
+    # Interning lets their FUNC_NOW lookups compare keys by identity.
+    def_path_str = sys.intern(".".join((func.__module__,) + def_path))
+
+    module = inspect.getmodule(func)
 
-    if inspect.unwrap(func) is not func:
+    if unwrapped_func is not func:
         _LOGGER.warn(
             f"Wrapping {def_path_str}, but hot_restart.wrap is not innermost decorator."
         )
@@ -575,45 +1054,36 @@ def wrap(
 
     @functools.wraps(func)
     def wrapped(*args, **kwargs):
-        global PROGRAM_SHOULD_EXIT
         global EXIT_THIS_FRAME
         EXIT_THIS_FRAME = False
-        restart_count = 0
         while not PROGRAM_SHOULD_EXIT and not EXIT_THIS_FRAME:
-            if restart_count > 0:
-                _LOGGER.info(f"Restarting {FUNC_NOW[def_path_str]!r}")
             try:
-                func_now = FUNC_NOW[def_path_str]
-                result = func_now(*args, **kwargs)
-                return result
+                return FUNC_NOW[def_path_str](*args, **kwargs)
+            except propagated_exceptions:
+                raise
             except Exception as e:
-                if isinstance(e, propagated_exceptions):
-                    raise e
-
-                if propagate_keyboard_interrupt and isinstance(e, KeyboardInterrupt):
-                    # The user is probably intentionally exiting
-                    PROGRAM_SHOULD_EXIT = True
-
                 if not PROGRAM_SHOULD_EXIT and not EXIT_THIS_FRAME:
                     excinfo = sys.exc_info()
 
-                    new_tb, num_dead_frames = _create_undead_traceback(
+                    new_tb, restart_frame = _create_undead_traceback(
                         excinfo[2], sys._getframe(1), wrapped
                     )
                     excinfo = (excinfo[0], excinfo[1], new_tb)
 
-                    _start_post_mortem(def_path_str, excinfo, num_dead_frames)
+                    _start_post_mortem(def_path_str, excinfo, restart_frame)
 
                 if PROGRAM_SHOULD_EXIT or EXIT_THIS_FRAME:
                     _LOGGER.warn(f"Re-raising {e!r}")
                     EXIT_THIS_FRAME = False
                     raise e
                 elif RELOAD_ON_CONTINUE:
-                    new_func = reload_function(def_path, FUNC_BASE[def_path_str])
+                    new_func = reload_function(
+                        def_path, FUNC_BASE[def_path_str], source_filename, module
+                    )
                     if new_func is not None:
                         print(f"> Reloaded {new_func!r}")
                         FUNC_NOW[def_path_str] = new_func
-            restart_count += 1
+                _LOGGER.info(f"Restarting {FUNC_NOW[def_path_str]!r}")
 
     setattr(wrapped, HOT_RESTART_ALREADY_WRAPPED, True)
 
@@ -621,29 +1091,32 @@ def wrap(
 
 
 def _create_undead_traceback(exc_tb, current_frame, wrapper_function):
-    """Create a new traceback object that includes the current frame's parents."""
-
-    # We want to default to one frame below the last one (the frame of the wrapper)
-    num_dead_frames = -1
-    dead_tb = exc_tb
-    while dead_tb is not None and dead_tb.tb_next is not None:
-        num_dead_frames += 1
-        dead_tb = dead_tb.tb_next
-    num_dead_frames = max(0, num_dead_frames)
-
-    # If we would end up in the frame of the wrapper, jump up one more frame to
-    # provide a more useful context
-    if dead_tb is not None and dead_tb.tb_frame.f_code == wrapper_function.__code__:
-        num_dead_frames += 1
+    """Create a new traceback object that includes the current frame's parents.
+
+    Also returns the frame to start debugging in.
+    """
+
+    # exc_tb starts at the frame of the wrapper, which caught the exception.
+    # We want to default to one frame below that (the wrapped function).
+    if exc_tb.tb_next is not None:
+        restart_frame = exc_tb.tb_next.tb_frame
+    else:
+        # If we would end up in the frame of the wrapper, jump up one more
+        # frame to provide a more useful context (set below).
+        restart_frame = None
         _LOGGER.warning("Debug frame is offset from restart frame")
 
     frame = current_frame
+    wrapper_code = wrapper_function.__code__
+    traceback_type = types.TracebackType
 
     # Create new traceback objects
     prev_tb = exc_tb
     while frame:
-        if frame.f_code != wrapper_function.__code__:
-            prev_tb = types.TracebackType(
+        if frame.f_code is not wrapper_code:
+            if restart_frame is None:
+                restart_frame = frame
+            prev_tb = traceback_type(
                 tb_next=prev_tb,
                 tb_frame=frame,
                 tb_lasti=frame.f_lasti,
@@ -651,12 +1124,12 @@ def _create_undead_traceback(exc_tb, current_frame, wrapper_function):
             )
         frame = frame.f_back
 
-    return prev_tb, num_dead_frames
+    return prev_tb, restart_frame
 
 
-def _start_post_mortem(def_path_str, excinfo, num_dead_frames):
+def _start_post_mortem(def_path_str, excinfo, restart_frame):
     if DEBUGGER == "pdb":
-        _start_pdb_post_mortem(def_path_str, excinfo, num_dead_frames)
+        _start_pdb_post_mortem(def_path_str, excinfo, restart_frame)
     elif DEBUGGER == "pydevd":
         _start_pydevd_post_mortem(def_path_str, excinfo)
     elif DEBUGGER == "pudb":
@@ -681,12 +1154,10 @@ def _start_pydevd_post_mortem(def_path_str, excinfo):
         f"hot-restart: call hot_restart.reraise() and continue to continue raising exception",
         file=sys.stderr,
     )
-    try:
-        import pydevd
-    except ImportError:
-        breakpoint()
-
-    py_db = pydevd.get_global_debugger()
+    # pydevd is only useful if a debugger already imported it, so avoid the
+    # import machinery (and a NameError if the import fails).
+    pydevd = sys.modules.get("pydevd")
+    py_db = pydevd.get_global_debugger() if pydevd is not None else None
     if py_db is None:
         breakpoint()
     else:
@@ -699,7 +1170,39 @@ def _start_pydevd_post_mortem(def_path_str, excinfo):
             additional_info.is_tracing -= 1
 
 
-def _start_pdb_post_mortem(def_path_str, excinfo, num_dead_frames):
+# Pool of pdb instances to re-use between post mortems.
+# Creating a pdb instance sets up readline and reads .pdbrc, so a few idle
+# instances are kept, allowing several threads to be debugged at once.
+PDB_POOL = []
+PDB_POOL_LOCK = threading.Lock()
+PDB_POOL_SIZE = 4
+
+
+def _acquire_pdb() -> HotRestartPdb:
+    with PDB_POOL_LOCK:
+        debugger = PDB_POOL.pop() if PDB_POOL else None
+    if debugger is None:
+        return HotRestartPdb()
+    # Pdb binds the streams when it is created, but they may have been replaced
+    # since (e.g. by contextlib.redirect_stdout).
+    debugger.stdin = sys.stdin
+    debugger.stdout = sys.stdout
+    return debugger
+
+
+def _release_pdb(debugger: HotRestartPdb):
+    # Don't keep the frames of the last session alive while idle
+    debugger.forget()
+    debugger.curframe_locals = None
+    debugger.cmdqueue.clear()
+    debugger.displaying.clear()
+    debugger.rcLines = list(debugger.pdbrc_lines)
+    with PDB_POOL_LOCK:
+        if len(PDB_POOL) < PDB_POOL_SIZE:
+            PDB_POOL.append(debugger)
+
+
+def _start_pdb_post_mortem(def_path_str, excinfo, restart_frame):
     global PRINT_HELP_MESSAGE
     global EXIT_THIS_FRAME
     _, e, tb = excinfo
@@ -716,10 +1219,9 @@ def _start_pdb_post_mortem(def_path_str, excinfo, num_dead_frames):
         print("> (q)uit to exit program")
         PRINT_HELP_MESSAGE = False
     print(">")
-    debugger = HotRestartPdb()
+    debugger = _acquire_pdb()
     debugger.reset()
-
-    debugger.cmdqueue.extend(["u"] * num_dead_frames)
+    debugger.restart_frame = restart_frame
 
     # Show function source
     # TODO(krzentner): Use original source, instead of
@@ -732,6 +1234,8 @@ def _start_pdb_post_mortem(def_path_str, excinfo, num_dead_frames):
         # If user input KeyboardInterrupt from the debugger,
         # break up one level.
         EXIT_THIS_FRAME = True
+    finally:
+        _release_pdb(debugger)
 
 
 def no_wrap(func_or_class):
@@ -745,54 +1249,97 @@ ignore = no_wrap
 def wrap_class(cls):
     _LOGGER.info(f"Wrapping class: {cls!r}")
     for k, v in list(vars(cls).items()):
-        if callable(v):
+        if getattr(v, HOT_RESTART_NO_WRAP, False) or getattr(
+            v, HOT_RESTART_ALREADY_WRAPPED, False
+        ):
+            continue
+        elif isinstance(v, (staticmethod, classmethod)):
+            if (
+                isinstance(v.__func__, types.FunctionType)
+                and v.__func__.__module__ == cls.__module__
+            ):
+                # Wrap the underlying function, so a staticmethod does not turn
+                # into a method.
+                _LOGGER.info(f"Wrapping {cls!r}.{k}")
+                setattr(cls, k, type(v)(wrap(v.__func__)))
+            else:
+                _LOGGER.debug(f"Not wrapping {cls!r}.{k}")
+        elif inspect.isbuiltin(v):
+            # Builtins have no source to reload from.
+            _LOGGER.debug(f"Not wrapping {cls!r}.{k}")
+        elif callable(v):
             _LOGGER.info(f"Wrapping {cls!r}.{k}")
             setattr(cls, k, wrap(v))
 
 
 def is_restarting_module():
-    return IS_RESTARTING_MODULE.val
+    return IS_RESTARTING_MODULE.get()
+
+
+def _module_name_of(v) -> Optional[str]:
+    # inspect.getmodule() reads __module__ too, but falls back to scanning
+    # sys.modules by filename, which is slow for large processes.
+    module_name = getattr(v, "__module__", None)
+    if isinstance(module_name, str):
+        return module_name
+    v_module = inspect.getmodule(v)
+    return v_module.__name__ if v_module else None
 
 
 def wrap_module(module_or_name=None):
     if module_or_name is None:
         # Need to go get module of calling frame
-        module_or_name = sys._getframe(1).f_globals["__name__"]
-        module_name = module_or_name
-    if isinstance(module_or_name, str):
+        module_name = sys._getframe(1).f_globals["__name__"]
+        module_d = sys.modules[module_name].__dict__
+    elif isinstance(module_or_name, str):
         module_name = module_or_name
-        module_d = sys.modules[module_or_name].__dict__
+        module_d = sys.modules[module_name].__dict__
     else:
         module_name = module_or_name.__name__
         module_d = module_or_name.__dict__
-    module_d = HOT_RESTART_MODULE_RELOAD_CONTEXT.val.get(module_name, module_d)
+    module_d = HOT_RESTART_MODULE_RELOAD_CONTEXT.get().get(module_name, module_d)
     _LOGGER.info(f"Wrapping module {module_name!r}")
 
+    # Formatting the messages calls repr() on every module value, which can be
+    # slow (e.g. large containers), so skip it unless it would be emitted.
+    log_info = _LOGGER.isEnabledFor(logging.INFO)
+    log_debug = _LOGGER.isEnabledFor(logging.DEBUG)
+
     out_d = {}
     for k, v in list(module_d.items()):
-        if getattr(v, HOT_RESTART_NO_WRAP, False):
-            _LOGGER.info(f"Skipping wrapping of no_wrap {v!r}")
+        if k in MODULE_DUNDERS:
+            # Module metadata, never wrappable.
+            continue
+        elif isinstance(v, types.BuiltinFunctionType):
+            if log_debug:
+                _LOGGER.debug(f"Not wrapping builtin {k!r}")
+        elif getattr(v, HOT_RESTART_NO_WRAP, False):
+            if log_info:
+                _LOGGER.info(f"Skipping wrapping of no_wrap {v!r}")
         elif getattr(v, HOT_RESTART_ALREADY_WRAPPED, False):
-            _LOGGER.info(f"Skipping already wrapped {v!r}")
+            if log_info:
+                _LOGGER.info(f"Skipping already wrapped {v!r}")
         elif inspect.isclass(v):
-            v_module = inspect.getmodule(v)
-            if v_module and v_module.__name__ == module_name:
-                _LOGGER.info(f"Wrapping class {v!r}")
+            v_module = _module_name_of(v)
+            if v_module == module_name:
+                if log_info:
+                    _LOGGER.info(f"Wrapping class {v!r}")
                 wrap_class(v)
-            else:
+            elif log_info:
                 _LOGGER.info(
                     f"Not wrapping in-scope class {v!r} since it originates from {v_module} != {module_name}"
                 )
         elif callable(v):
-            v_module = inspect.getmodule(v)
-            if v_module and v_module.__name__ == module_name:
-                _LOGGER.info(f"Wrapping callable {v!r}")
+            v_module = _module_name_of(v)
+            if v_module == module_name:
+                if log_info:
+                    _LOGGER.info(f"Wrapping callable {v!r}")
                 out_d[k] = wrap(v)
-            else:
+            elif log_info:
                 _LOGGER.info(
                     f"Not wrapping in-scope callable {v!r} since it originates from {v_module} != {module_name}"
                 )
-        else:
+        elif log_debug:
             _LOGGER.debug(f"Not wrapping {v!r}")
 
     for k, v in out_d.items():
@@ -802,11 +1349,11 @@ def wrap_module(module_or_name=None):
 def restart_module(module_or_name=None):
     if module_or_name is None:
         # Need to go get module of calling frame
-        module_or_name = sys._getframe(1).f_globals["__name__"]
-        module_name = module_or_name
-    if isinstance(module_or_name, str):
-        module = sys.modules[module_or_name]
+        module_name = sys._getframe(1).f_globals["__name__"]
+        module = sys.modules[module_name]
+    elif isinstance(module_or_name, str):
         module_name = module_or_name
+        module = sys.modules[module_name]
     else:
         module = module_or_name
         module_name = module.__name__
@@ -814,8 +1361,7 @@ def restart_module(module_or_name=None):
     if source_filename is None:
         raise ReloadException(f"Could not determine source of {module!r}")
     try:
-        with open(source_filename) as f:
-            source = f.read()
+        source, module_ast, _ = load_source(source_filename)
     except (OSError, FileNotFoundError) as e:
         raise ReloadException(f"Could not load {module!r} source: {e!r}")
 
@@ -825,19 +1371,39 @@ def restart_module(module_or_name=None):
     _LOGGER.debug("=== RELOAD SOURCE END ===")
 
     # Exec new source in copy of the context of the old module
-    ctxt = dict(vars(module))
-    code = compile(source, source_filename, "exec")
+    module_d = vars(module)
+    ctxt = module_d.copy()
+    # The ast is shared with wrap() and reload_function, so is usually already
+    # parsed.
+    cached = MODULE_CODE_CACHE.get(source_filename)
+    if cached is not None and cached[0] is module_ast:
+        code = cached[1]
+    else:
+        code = compile(module_ast, source_filename, "exec")
+        MODULE_CODE_CACHE[source_filename] = (module_ast, code)
 
+    restarting_token = IS_RESTARTING_MODULE.set(True)
+    context_token = HOT_RESTART_MODULE_RELOAD_CONTEXT.set(
+        types.MappingProxyType(
+            {**HOT_RESTART_MODULE_RELOAD_CONTEXT.get(), module_name: ctxt}
+        )
+    )
     try:
-        IS_RESTARTING_MODULE.val = True
-        HOT_RESTART_MODULE_RELOAD_CONTEXT.val[module_name] = ctxt
         exec(code, ctxt, ctxt)
     finally:
-        IS_RESTARTING_MODULE.val = False
-        del HOT_RESTART_MODULE_RELOAD_CONTEXT.val[module_name]
+        HOT_RESTART_MODULE_RELOAD_CONTEXT.reset(context_token)
+        IS_RESTARTING_MODULE.reset(restarting_token)
 
-    for k, v in ctxt.items():
-        setattr(module, k, v)
+    if type(module) is types.ModuleType:
+        # Plain modules have no custom __setattr__, so merging the dicts in C
+        # is equivalent to setting each attribute.
+        module_d.update(ctxt)
+    else:
+        # The module's class may have been replaced by a subclass with a
+        # custom __setattr__.
+        for k, v in ctxt.items():
+            if module_d.get(k, ctxt) is not v:
+                setattr(module, k, v)
 
 
 # Convenient alias
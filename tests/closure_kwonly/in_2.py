@@ -0,0 +1,15 @@
+import hot_restart
+
+
+def outer_fn():
+    a, b = 1, 2
+
+    @hot_restart.wrap
+    def inner_fn(s, *, suffix="?"):
+        print("b", b, s + suffix)
+
+    inner_fn("test")
+
+
+if not hot_restart.is_restarting_module():
+    outer_fn()
@@ -0,0 +1,14 @@
+import hot_restart
+
+# page onepage two
+
+
+def inner(x):
+    print("in inner:", x)
+    assert False, "whoops"
+
+
+hot_restart.wrap_module()
+
+if __name__ == "__main__" and not hot_restart.is_restarting_module():
+    inner(20)
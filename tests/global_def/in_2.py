@@ -0,0 +1,15 @@
+import hot_restart
+
+
+def setup():
+    global handler
+
+    def handler(x):
+        print("handled", x)
+
+
+setup()
+hot_restart.wrap_module()
+
+if not hot_restart.is_restarting_module():
+    handler(5)
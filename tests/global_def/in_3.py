@@ -0,0 +1,16 @@
+import hot_restart
+
+# handler is now one line lower than when it was wrapped.
+
+def setup():
+    global handler
+
+    def handler(x):
+        print("handled", x)
+
+
+setup()
+hot_restart.wrap_module()
+
+if not hot_restart.is_restarting_module():
+    handler(5)
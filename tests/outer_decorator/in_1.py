@@ -0,0 +1,16 @@
+import functools
+
+import hot_restart
+
+LIMIT = 3
+
+
+@hot_restart.wrap
+@functools.lru_cache
+def add_limit(x):
+    assert False
+    return x + eval("LIMIT")
+
+
+if __name__ == "__main__":
+    print("got", add_limit(1))
@@ -0,0 +1,17 @@
+import hot_restart
+
+
+class Shape:
+    def __init__(self, side):
+        self.side = side
+
+    @staticmethod
+    def square(x):
+        return x * x
+
+    def area(self):
+        return self.square(self.side)
+
+
+hot_restart.wrap_module()
+print("area", Shape(7).area(), "square", Shape.square(3))
@@ -101,6 +101,21 @@ def test_closure():
     child.sendline("c")
     child.expect("y 2 x 1 test", timeout=0.5)
 
+
+def test_closure_kwonly():
+    # The reloaded function closes over fewer variables, and has a different
+    # keyword-only default.
+    test_dir = "closure_kwonly"
+    tmp = mktmp(test_dir)
+    copy(test_dir, "in_1.py", tmp)
+    child = pexpect.spawn("python", [tmp.name])
+    exp(child, "(Pdb)")
+    assert b"9  ->" in child.before
+    copy(test_dir, "in_2.py", tmp)
+    child.sendline("c")
+    child.expect("b 2 test\\?", timeout=0.5)
+
+
 def test_nested_functions():
     test_dir = "nested_functions"
     tmp = mktmp(test_dir)
@@ -116,10 +131,100 @@ def test_nested_functions():
     child.expect("hi", timeout=0.5)
 
 
+def test_staticmethod():
+    test_dir = "staticmethod"
+    tmp = mktmp(test_dir)
+    copy(test_dir, "in_1.py", tmp)
+    child = pexpect.spawn("python", [tmp.name])
+    exp(child, "(Pdb)")
+    assert b"10  ->" in child.before
+    copy(test_dir, "in_2.py", tmp)
+    child.sendline("c")
+    child.expect("area 49 square 9", timeout=0.5)
+
+
+def test_global_def():
+    # The __qualname__ of handler does not include setup, since it is global.
+    test_dir = "global_def"
+    tmp = mktmp(test_dir)
+    copy(test_dir, "in_1.py", tmp)
+    child = pexpect.spawn("python", [tmp.name])
+    exp(child, "(Pdb)")
+    assert b"8  ->" in child.before
+    copy(test_dir, "in_2.py", tmp)
+    child.sendline("c")
+    child.expect("handled 5", timeout=0.5)
+
+
+def test_global_def_moved():
+    # The definition is no longer at its original line when reloading.
+    test_dir = "global_def"
+    tmp = mktmp(test_dir)
+    copy(test_dir, "in_1.py", tmp)
+    child = pexpect.spawn("python", [tmp.name])
+    exp(child, "(Pdb)")
+    assert b"8  ->" in child.before
+    copy(test_dir, "in_3.py", tmp)
+    child.sendline("c")
+    child.expect("handled 5", timeout=0.5)
+
+
+def test_form_feed():
+    # Form feeds split lines for str.splitlines(), but not for Python.
+    test_dir = "form_feed"
+    tmp = mktmp(test_dir)
+    copy(test_dir, "in_1.py", tmp)
+    child = pexpect.spawn("python", [tmp.name])
+
+    exp(child, "(Pdb)")
+    assert b"8  ->" in child.before
+    child.sendline("c")
+
+    exp(child, "(Pdb)")
+    assert b"8  ->" in child.before
+    copy(test_dir, "in_2.py", tmp)
+    child.sendline("c")
+
+    child.expect("fixed 20", timeout=0.5)
+
+
+def test_outer_decorator():
+    # The reloaded function keeps the namespace it was reloaded in as its
+    # globals, since wrap is not the innermost decorator.
+    test_dir = "outer_decorator"
+    tmp = mktmp(test_dir)
+    copy(test_dir, "in_1.py", tmp)
+    child = pexpect.spawn("python", [tmp.name])
+    exp(child, "(Pdb)")
+    assert b"11  ->" in child.before
+    copy(test_dir, "in_2.py", tmp)
+    child.sendline("c")
+    child.expect("got 4", timeout=0.5)
+
+
+def test_thread():
+    test_dir = "thread"
+    tmp = mktmp(test_dir)
+    copy(test_dir, "in_1.py", tmp)
+    child = pexpect.spawn("python", [tmp.name])
+    exp(child, "(Pdb)")
+    assert b"7  ->" in child.before
+    copy(test_dir, "in_2.py", tmp)
+    child.sendline("c")
+    child.expect("worked 3", timeout=0.5)
+
+
 if __name__ == "__main__":
     test_basic()
     test_basic_twice()
     test_basic_reload_module()
     test_child_class()
     test_closure()
+    test_closure_kwonly()
     test_nested_functions()
+    test_staticmethod()
+    test_global_def()
+    test_global_def_moved()
+    test_form_feed()
+    test_outer_decorator()
+    test_thread()
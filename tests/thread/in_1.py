@@ -0,0 +1,18 @@
+import threading
+
+import hot_restart
+
+
+def work(x):
+    assert False
+    print("worked", x)
+
+
+def main():
+    # Wrapped in this thread, not the thread that imported hot_restart.
+    hot_restart.wrap(work)(3)
+
+
+thread = threading.Thread(target=main)
+thread.start()
+thread.join()
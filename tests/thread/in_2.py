@@ -0,0 +1,17 @@
+import threading
+
+import hot_restart
+
+
+def work(x):
+    print("worked", x)
+
+
+def main():
+    # Wrapped in this thread, not the thread that imported hot_restart.
+    hot_restart.wrap(work)(3)
+
+
+thread = threading.Thread(target=main)
+thread.start()
+thread.join()